@@ -2,74 +2,298 @@ import pystray
 from PIL import Image
 import subprocess
 import threading
-import json
+import asyncio
+try:
+    import orjson
+except ImportError:
+    orjson = None
+    import json
 import signal
 import os
+import io
+import sys
 import contextlib
+import itertools
+import enum
 from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
 import ctypes
+from ctypes import wintypes
 
 #=============================================================================================================================#
 
+# all the rclone process handling runs on this loop, in its own thread started by main
+event_loop = asyncio.new_event_loop()
+
+def log_failure(future):
+    # nobody waits on most of these futures, so make sure errors still end up in the log
+    if not future.cancelled() and future.exception() is not None:
+        import traceback
+        print("".join(traceback.format_exception(future.exception())))
+
+def run_in_background(coro, icon: pystray.Icon | None = None):
+    # menu callbacks run on the tray's message loop, so keep slow rclone start/stop off it
+    future = asyncio.run_coroutine_threadsafe(coro, event_loop)
+    future.add_done_callback(log_failure)
+    if icon:
+        # the tray only rebuilds its menu right after the click, which is before the action is done
+        future.add_done_callback(lambda f: icon.update_menu())
+    return future
+
+def in_background(func, *args):
+    # the icon goes in last so the action can refresh the menu once it's done
+    def callback(icon, item):
+        run_in_background(func(*args, icon))
+    return callback
+
+#=============================================================================================================================#
+
+class IO_COUNTERS(ctypes.Structure):
+    _fields_ = [
+        ("ReadOperationCount", ctypes.c_ulonglong),
+        ("WriteOperationCount", ctypes.c_ulonglong),
+        ("OtherOperationCount", ctypes.c_ulonglong),
+        ("ReadTransferCount", ctypes.c_ulonglong),
+        ("WriteTransferCount", ctypes.c_ulonglong),
+        ("OtherTransferCount", ctypes.c_ulonglong),
+    ]
+
+class JOBOBJECT_BASIC_LIMIT_INFORMATION(ctypes.Structure):
+    _fields_ = [
+        ("PerProcessUserTimeLimit", wintypes.LARGE_INTEGER),
+        ("PerJobUserTimeLimit", wintypes.LARGE_INTEGER),
+        ("LimitFlags", wintypes.DWORD),
+        ("MinimumWorkingSetSize", ctypes.c_size_t),
+        ("MaximumWorkingSetSize", ctypes.c_size_t),
+        ("ActiveProcessLimit", wintypes.DWORD),
+        ("Affinity", ctypes.c_size_t),
+        ("PriorityClass", wintypes.DWORD),
+        ("SchedulingClass", wintypes.DWORD),
+    ]
+
+class JOBOBJECT_EXTENDED_LIMIT_INFORMATION(ctypes.Structure):
+    _fields_ = [
+        ("BasicLimitInformation", JOBOBJECT_BASIC_LIMIT_INFORMATION),
+        ("IoInfo", IO_COUNTERS),
+        ("ProcessMemoryLimit", ctypes.c_size_t),
+        ("JobMemoryLimit", ctypes.c_size_t),
+        ("PeakProcessMemoryUsed", ctypes.c_size_t),
+        ("PeakJobMemoryUsed", ctypes.c_size_t),
+    ]
+
+JobObjectExtendedLimitInformation = 9
+JOB_OBJECT_LIMIT_KILL_ON_JOB_CLOSE = 0x2000
+PROCESS_TERMINATE = 0x0001
+ERROR_ACCESS_DENIED = 5
+PROCESS_SET_QUOTA = 0x0100
+
+class ProcessJob:
+    # every process assigned here gets killed by windows as soon as the job handle is closed
+    def __init__(self):
+        self._kernel32 = kernel32 = ctypes.WinDLL("kernel32", use_last_error = True)
+        kernel32.CreateJobObjectW.restype = wintypes.HANDLE
+        kernel32.CreateJobObjectW.argtypes = [wintypes.LPVOID, wintypes.LPCWSTR]
+        kernel32.SetInformationJobObject.argtypes = [wintypes.HANDLE, ctypes.c_int, wintypes.LPVOID, wintypes.DWORD]
+        kernel32.AssignProcessToJobObject.argtypes = [wintypes.HANDLE, wintypes.HANDLE]
+        kernel32.OpenProcess.restype = wintypes.HANDLE
+        kernel32.OpenProcess.argtypes = [wintypes.DWORD, wintypes.BOOL, wintypes.DWORD]
+        kernel32.CloseHandle.argtypes = [wintypes.HANDLE]
+
+        self._handle = kernel32.CreateJobObjectW(None, None)
+        if not self._handle:
+            raise ctypes.WinError(ctypes.get_last_error())
+        info = JOBOBJECT_EXTENDED_LIMIT_INFORMATION()
+        info.BasicLimitInformation.LimitFlags = JOB_OBJECT_LIMIT_KILL_ON_JOB_CLOSE
+        if not kernel32.SetInformationJobObject(self._handle, JobObjectExtendedLimitInformation, ctypes.byref(info), ctypes.sizeof(info)):
+            error = ctypes.WinError(ctypes.get_last_error())
+            self.close()
+            raise error
+
+    def assign(self, pid: int) -> bool:
+        # best effort, a process that isn't in the job just gets the normal unmount on exit
+        if not self._handle:
+            return False
+        process_handle = self._kernel32.OpenProcess(PROCESS_SET_QUOTA | PROCESS_TERMINATE, False, pid)
+        if not process_handle:
+            return False
+        try:
+            return bool(self._kernel32.AssignProcessToJobObject(self._handle, process_handle))
+        finally:
+            self._kernel32.CloseHandle(process_handle)
+
+    def close(self):
+        if self._handle:
+            self._kernel32.CloseHandle(self._handle)
+            self._handle = None
+
+#=============================================================================================================================#
+
+class State(enum.Enum):
+    UNMOUNTED = enum.auto()
+    MOUNTING = enum.auto()
+    MOUNTED = enum.auto()
+    UNMOUNTING = enum.auto()
+
 class HDD:
-    def __init__(self, *, hostname: str, mount_dir: str, mount_point: str, volume_name: str = "HDD", cache_dir: str = "temp", extra_args: list[str] = []):
+    icon: pystray.Icon | None = None
+    # rclone won't mount if it can't bind its rc port, so stay clear of 5572 (rclone's default)
+    # and of the windows dynamic port range (49152 and up), which hyper-v and wsl like to reserve
+    _rc_ports = itertools.count(45720)
+    job: ProcessJob | None = None
+
+    def __init__(self, *, hostname: str, mount_dir: str, mount_point: str, volume_name: str = "HDD", cache_dir: str = "temp", extra_args: list[str] = [], log: bool = True, rc_addr: str | None = None):
         self.hostname = hostname
         self.mount_dir = mount_dir
         self.mount_point = mount_point
         self.volume_name = volume_name
-        try:
-            os.mkdir(cache_dir)
-        except OSError:
-            pass
         self.cache_dir = cache_dir
+        self.log = log
+        self.cache_path = f"{cache_dir}\\{mount_dir}"
+        self._rc_addr = rc_addr or f"127.0.0.1:{next(self._rc_ports)}"
+        self._argv = [
+            "C:\\bin\\rclone",
+            "mount", f"{hostname}:{mount_dir}", mount_point,
+            "--volname", volume_name,
+            "--vfs-cache-mode", "writes",
+            "--cache-dir", self.cache_path,
+            "--file-perms", "0777",
+            "--dir-perms", "0777",
+            "--no-modtime",
+            "--no-console",
+            "--rc",
+            "--rc-addr", self._rc_addr,
+            # throughput tuning, rclone takes the last value given so extra_args can override any of these
+            "--transfers", "1",
+            "--vfs-cache-poll-interval", "10s",
+            "--dir-cache-time", "72h",
+            "--vfs-read-chunk-size", "128M",
+            "--vfs-read-ahead", "128M",
+            *extra_args
+        ]
         self.process = None
-        self.thread = None
-        self._lock = threading.Lock()
-
-    def log_to_stdout(self):
-        while self.process:
-            line = self.process.stdout.readline().decode("utf-8")
-            if line:
-                print(line)
+        self._lock = asyncio.Lock()
+        self._state = State.UNMOUNTED
+        self._tasks = set()
+
+    def _spawn(self, coro):
+        # the loop only keeps weak references to tasks, hold on to them until they finish
+        task = event_loop.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        task.add_done_callback(log_failure)
+
+    async def log_to_stdout(self, process: asyncio.subprocess.Process):
+        # drain in big blocks instead of line by line, rclone already writes utf-8 so pass the bytes through as is
+        out = sys.stdout
+        while True:
+            data = await process.stdout.read(65536)
+            if data:
+                out.buffer.write(data)
             else:
                 return
 
+    async def watch_exit(self, process: asyncio.subprocess.Process):
+        # notice it here if rclone exited on its own
+        if self.log:
+            await self.log_to_stdout(process)
+        await process.wait()
+        async with self._lock:
+            if self.process is process and self._state is State.MOUNTED:
+                self.process = None
+                self._state = State.UNMOUNTED
+                if self.icon:
+                    self.icon.update_menu()
+
+    async def prefetch_metadata(self):
+        # warm up the dir cache so the first browse doesn't stat everything on demand
+        await asyncio.sleep(2)
+        process = await asyncio.create_subprocess_exec(
+            "C:\\bin\\rclone", "rc", "vfs/refresh", "recursive=true", "_async=true", "--rc-addr", self._rc_addr,
+            stdin = subprocess.DEVNULL,
+            stdout = subprocess.DEVNULL,
+            stderr = subprocess.DEVNULL
+        )
+        await process.wait()
+
     def is_mounted(self) -> bool:
-        return self.process is not None and self.process.poll() is None
-
-    def mount(self):
-        with self._lock:
-            if not self.is_mounted():
-                self.process = subprocess.Popen(
-                    [
-                        "C:\\bin\\rclone",
-                        "mount", f"{self.hostname}:{self.mount_dir}", self.mount_point,
-                        "--volname", self.volume_name,
-                        "--vfs-cache-mode", "writes",
-                        "--cache-dir", f"{self.cache_dir}\\{self.mount_dir}",
-                        "--dir-cache-time", "1m0s",
-                        "--file-perms", "0777",
-                        "--dir-perms", "0777",
-                        "--no-modtime",
-                        "--no-console"
-                    ],
-                    stdin = subprocess.PIPE,
-                    stdout = subprocess.PIPE,
-                    stderr = subprocess.STDOUT,
-                    creationflags = subprocess.CREATE_NEW_PROCESS_GROUP
-                )
-                threading.Thread(target = self.log_to_stdout).start()
+        return self._state is State.MOUNTED
 
-    def unmount(self):
-        with self._lock:
-            if self.is_mounted():
-                self.process.send_signal(signal.CTRL_BREAK_EVENT)
-                self.process.wait()
-                self.process = None
+    async def _mount_locked(self):
+        if self._state is not State.UNMOUNTED:
+            return
+        self._state = State.MOUNTING
+        try:
+            self.process = await asyncio.create_subprocess_exec(
+                *self._argv,
+                stdin = subprocess.DEVNULL,
+                stdout = subprocess.PIPE if self.log else subprocess.DEVNULL,
+                stderr = subprocess.STDOUT if self.log else subprocess.DEVNULL,
+                creationflags = subprocess.CREATE_NEW_PROCESS_GROUP
+            )
+        except:
+            self._state = State.UNMOUNTED
+            raise
+        if self.job:
+            self.job.assign(self.process.pid)
+        self._state = State.MOUNTED
+        self._spawn(self.watch_exit(self.process))
+        self._spawn(self.prefetch_metadata())
+
+    def _send_break(self):
+        # straight to the api rather than send_signal, which raises if rclone already exited on its own
+        kernel32 = ctypes.WinDLL("kernel32", use_last_error = True)
+        kernel32.GenerateConsoleCtrlEvent.argtypes = [wintypes.DWORD, wintypes.DWORD]
+        if kernel32.GenerateConsoleCtrlEvent(signal.CTRL_BREAK_EVENT, self.process.pid):
+            return
+        # no graceful way to stop it then, don't leave the unmount waiting forever
+        print(f"Could not send CTRL_BREAK to {self.volume_name}: {ctypes.WinError(ctypes.get_last_error())}")
+        try:
+            self.process.terminate()
+        except ProcessLookupError:
+            pass
+
+    async def _unmount_locked(self, timeout: float | None = None):
+        if self._state is not State.MOUNTED:
+            return
+        self._state = State.UNMOUNTING
+        try:
+            self._send_break()
+            await asyncio.wait_for(self.process.wait(), timeout)
+        except asyncio.TimeoutError:
+            # only used on exit, whatever is left gets killed along with the job
+            pass
+        finally:
+            self.process = None
+            self._state = State.UNMOUNTED
+
+    async def mount(self):
+        async with self._lock:
+            await self._mount_locked()
+
+    async def unmount(self, timeout: float | None = None):
+        async with self._lock:
+            await self._unmount_locked(timeout)
+
+    async def remount(self):
+        # hold the lock across both steps so nothing can slip in between
+        async with self._lock:
+            await self._unmount_locked()
+            await self._mount_locked()
+
+    def _on_mount(self, icon, item):
+        run_in_background(self.mount(), icon)
+
+    def _on_unmount(self, icon, item):
+        run_in_background(self.unmount(), icon)
 
-    def remount(self):
-        self.unmount()
-        self.mount()
+    def _on_remount(self, icon, item):
+        run_in_background(self.remount(), icon)
+
+    def _mounted(self, item) -> bool:
+        return self._state is State.MOUNTED
+
+    def _not_mounted(self, item) -> bool:
+        return self._state is not State.MOUNTED
 
     def current_label(self, icon):
         if self.is_mounted():
@@ -79,40 +303,112 @@ class HDD:
 
     def construct_submenu(self):
         return [
-            pystray.MenuItem("Mount", lambda icon, item: self.mount(), enabled = lambda icon: not self.is_mounted()),
-            pystray.MenuItem("Unmount", lambda icon, item: self.unmount(), enabled = lambda icon: self.is_mounted()),
-            pystray.MenuItem("Remount", lambda icon, item: self.remount(), enabled = lambda icon: self.is_mounted()),
+            pystray.MenuItem("Mount", self._on_mount, enabled = self._not_mounted),
+            pystray.MenuItem("Unmount", self._on_unmount, enabled = self._mounted),
+            pystray.MenuItem("Remount", self._on_remount, enabled = self._mounted),
         ]
 
 #=============================================================================================================================#
 
-def mount_all(all_hdds: list[HDD]):
-    for hdd in all_hdds:
-        hdd.mount()
+async def mount_all(all_hdds: tuple[HDD, ...], icon: pystray.Icon | None = None):
+    await asyncio.gather(*(hdd.mount() for hdd in all_hdds))
+    if icon:
+        icon.update_menu()
 
-def unmount_all(all_hdds: list[HDD]):
-    for hdd in all_hdds:
-        hdd.unmount()
+async def unmount_all(all_hdds: tuple[HDD, ...], icon: pystray.Icon | None = None, timeout: float | None = None):
+    await asyncio.gather(*(hdd.unmount(timeout) for hdd in all_hdds))
+    if icon:
+        icon.update_menu()
 
-def graceful_exit(all_hdds: list[HDD]):
+async def finish_tasks(all_hdds: tuple[HDD, ...], timeout: float = 2.0):
+    # let the readers drain rclone's last words into the log before it gets closed, give up on anything still left
+    tasks = [task for hdd in all_hdds for task in hdd._tasks]
+    if not tasks:
+        return
+    _, pending = await asyncio.wait(tasks, timeout = timeout)
+    for task in pending:
+        task.cancel()
+
+def prepare_cache_dirs(all_hdds: tuple[HDD, ...]):
+    def make(hdd: HDD):
+        try:
+            os.makedirs(hdd.cache_path, exist_ok = True)
+        except OSError as e:
+            # rclone will complain about the path itself when this drive mounts
+            print(f"Could not create cache directory for {hdd.volume_name}: {e}")
+    with ThreadPoolExecutor(max_workers = max(1, len(all_hdds))) as executor:
+        list(executor.map(make, all_hdds))
+
+def graceful_exit():
     def func(icon, item: str):
-        unmount_all(all_hdds)
+        # drives are unmounted on the way out of main
         icon.stop()
     return func
 
+def create_headless_console() -> subprocess.Popen:
+    # rclone needs to share a console with us to receive CTRL_BREAK, so borrow a hidden one from an idle cmd
+    startupinfo = subprocess.STARTUPINFO()
+    startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+    startupinfo.wShowWindow = subprocess.SW_HIDE
+    console = subprocess.Popen(
+        ["cmd", "/d", "/q", "/k", "echo ready"],
+        stdin = subprocess.PIPE,
+        stdout = subprocess.PIPE,
+        stderr = subprocess.DEVNULL,
+        startupinfo = startupinfo,
+        creationflags = subprocess.CREATE_NEW_CONSOLE
+    )
+    # cmd only gets to run echo once its console exists, so this line means it's safe to attach
+    console.stdout.readline()
+    kernel32 = ctypes.WinDLL("kernel32", use_last_error = True)
+    if not kernel32.AttachConsole(console.pid):
+        error = ctypes.get_last_error()
+        if error == ERROR_ACCESS_DENIED:
+            # started from a console already, rclone inherits that one instead
+            print("Already attached to a console, not using the headless one")
+        else:
+            console.kill()
+            raise ctypes.WinError(error)
+    return console
+
+async def flush_periodically(file: io.TextIOWrapper, interval: float = 1.0):
+    # the log is block buffered, push it to disk every now and then so it stays reasonably fresh
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            file.flush()
+        except ValueError:
+            # file already closed
+            return
+
 def main():
     try:
         os.mkdir("logs")
     except OSError:
         pass
     today = datetime.now(tz = timezone.utc)
-    with open(f"logs/app.{today.strftime('%Y-%m-%d')}.log", "a", encoding = "utf-8", buffering = 1) as f:
-        with contextlib.redirect_stdout(f):
-            with open("automount.json", encoding = "utf-8") as f:
-                config = json.load(f)
-            all_hdds = [HDD(**o) for o in config["drives"]]
+    log_file = io.TextIOWrapper(
+        open(f"logs/app.{today.strftime('%Y-%m-%d')}.log", "ab", buffering = 65536),
+        encoding = "utf-8",
+        line_buffering = False,
+        # prints go straight into the shared 64 KiB buffer, so they stay in order with rclone's raw output without a flush
+        write_through = True
+    )
+    with log_file:
+        threading.Thread(target = event_loop.run_forever, daemon = True).start()
+        flusher = run_in_background(flush_periodically(log_file))
+        with contextlib.redirect_stdout(log_file):
+            with open("automount.json", "rb") as f:
+                raw = f.read()
+            config = orjson.loads(raw) if orjson else json.loads(raw)
+            if "rc_port_base" in config:
+                HDD._rc_ports = itertools.count(config["rc_port_base"])
+            all_hdds = tuple(HDD(**o) for o in config["drives"])
+            prepare_cache_dirs(all_hdds)
 
-            image = Image.open("automount.png")
+            # decode once up front, convert() materializes the pixels so the tray never goes back to the file
+            with Image.open("automount.png") as source:
+                image = source.convert("RGBA")
             app = pystray.Icon(
                 "automount",
                 image,
@@ -120,34 +416,42 @@ def main():
                 menu = pystray.Menu(
                     *(pystray.MenuItem(d.current_label, pystray.Menu(d.construct_submenu)) for d in all_hdds),
                     pystray.Menu.SEPARATOR,
-                    pystray.MenuItem("\u2795 Mount all", lambda icon, item: mount_all(all_hdds)),
-                    pystray.MenuItem("\u2796 Unmount all", lambda icon, item: unmount_all(all_hdds)),
+                    pystray.MenuItem("\u2795 Mount all", in_background(mount_all, all_hdds)),
+                    pystray.MenuItem("\u2796 Unmount all", in_background(unmount_all, all_hdds)),
                     pystray.Menu.SEPARATOR,
-                    pystray.MenuItem("Exit", graceful_exit(all_hdds))
+                    pystray.MenuItem("Exit", graceful_exit())
                 )
             )
+            HDD.icon = app
 
             try:
-                # create headless console
-                kernel32 = ctypes.WinDLL("kernel32", use_last_error = True)
-                console = subprocess.Popen(
-                    "echo ready & cmd pause",
-                    stdin = subprocess.PIPE,
-                    stdout = subprocess.PIPE,
-                    stderr = subprocess.DEVNULL,
-                    shell = True
-                )
-                console.stdout.readline()
-                kernel32.AttachConsole(console.pid)
+                HDD.job = ProcessJob()
+            except OSError:
+                import traceback
+                print(traceback.format_exc())
+
+            console = None
+            try:
+                console = create_headless_console()
 
                 app.run()
             except:
                 import traceback
                 print(traceback.format_exc())
             finally:
-                unmount_all(all_hdds)
+                # give rclone a moment to shut down cleanly, then let closing the job kill the stragglers
+                if HDD.job:
+                    run_in_background(unmount_all(all_hdds, timeout = 0.5)).result()
+                    HDD.job.close()
+                else:
+                    run_in_background(unmount_all(all_hdds)).result()
+                run_in_background(finish_tasks(all_hdds)).result()
                 app.stop()
-                console.kill()
+                if console:
+                    console.kill()
+                flusher.cancel()
+                event_loop.call_soon_threadsafe(event_loop.stop)
+                log_file.flush()
 
 if __name__ == "__main__":
     main()